@@ -0,0 +1,85 @@
+import pytest
+import math
+import statistics
+from welford import Welford
+from aggregate import aggregateChunk, aggregateListings, chunkListings
+
+listings = [
+    {'id': 1, 'item': {'id': 10}, 'quantity': 1, 'buyout': 100},
+    {'id': 2, 'item': {'id': 10}, 'quantity': 2, 'buyout': 300},
+    {'id': 3, 'item': {'id': 11}, 'quantity': 5, 'unit_price': 7},
+    {'id': 4, 'item': {'id': 12}, 'quantity': 1, 'unit_price': 9},
+    {'id': 5, 'item': {'id': 11}, 'quantity': 1, 'unit_price': 20},
+    {'id': 6, 'item': {'id': 13}, 'quantity': 1},
+    {'id': 7, 'item': {'id': 10}, 'quantity': 1, 'buyout': 250}
+]
+
+class TestAggregate():
+
+    def test_welford_merge(self):
+        '''Test merging two Welfords matches a single pass over all values'''
+        a = Welford(range(10))
+        b = Welford([3, 50, 7])
+        a.merge(b)
+        full = Welford(list(range(10)) + [3, 50, 7])
+        assert a.k == full.k
+        assert a.mean == pytest.approx(full.mean)
+        assert a.std == pytest.approx(full.std)
+        assert a.std_pop == pytest.approx(statistics.pstdev(list(range(10)) + [3, 50, 7]))
+
+    def test_welford_merge_empty(self):
+        '''Test merging an empty Welford leaves the values unchanged'''
+        a = Welford([1, 2, 3])
+        a.merge(Welford())
+        assert a.k == 3
+        assert a.mean == pytest.approx(2)
+
+    def test_chunkListings(self):
+        '''Test formatting drops invalid items and listings without a price'''
+        formatted_list = list()
+        tasks = list(chunkListings(listings, {12}, 2, 100, formatted_list))
+        assert [(shard, list(item_ids), list(prices), chunks) for shard, item_ids, quantities, prices, chunks in tasks] == [
+            (0, [10, 10, 10], [100, 150, 250], 1), (1, [11, 11], [7, 20], 1)]
+        assert sorted(x[3] for x in formatted_list) == [1, 2, 3, 5, 7]
+
+    def test_chunkListings_stream(self):
+        '''Test full chunks are yielded before the stream ends and new IDs are resolved first'''
+        events = list()
+        def stream():
+            for x in listings:
+                events.append(x['id'])
+                yield x
+        for shard, item_ids, quantities, prices, chunks in chunkListings(stream(), (), 2, 2, resolve=lambda ids: events.append(ids)):
+            events.append((shard, len(item_ids), chunks))
+        assert events == [1, 2, (0, 2, 0), 3, 4, 5, (1, 2, 0), 6, 7, (0, 2, 0), [10, 11, 12],
+            (0, 0, 3), (1, 0, 2)]
+
+    def test_aggregateChunk(self):
+        '''Test partial aggregates of a chunk'''
+        shard, item_ids, quantities, prices, chunks = next(chunkListings(listings, (), 1, 100))
+        shard, rows, partials, chunks = aggregateChunk((0, item_ids, quantities, prices, 0))
+        assert shard == 0 and rows is None
+        assert sorted(partials.keys()) == [10, 11, 12]
+        k, M, S, quantity, high, low = partials[10]
+        assert (k, quantity, high, low) == (3, 4, 250, 100) and M == pytest.approx(500 / 3)
+        shard, rows, partials, chunks = aggregateChunk((0, item_ids, quantities, prices, 1))
+        assert partials is None
+        assert [row[0] for row in rows] == [10, 11, 12]
+
+    def test_aggregateListings_keep_listings(self):
+        '''Test the formatted listings are returned for the snapshot table'''
+        res = aggregateListings(listings, {12}, 2, lambda b: list(b), keep_listings=True)
+        assert sorted(res) == [(10, 1, 100, 1), (10, 1, 250, 7), (10, 2, 150, 2), (11, 1, 20, 5), (11, 5, 7, 3)]
+
+    @pytest.mark.parametrize("chunk_size", [1, 2, 100])
+    def test_aggregateListings(self, chunk_size):
+        '''Test pooled aggregation matches the statistics of insertNewListings'''
+        batches = list()
+        res = aggregateListings(listings * 10, {12}, 2, lambda b: batches.extend(b), chunk_size=chunk_size)
+        assert res is None
+        rows = sorted(row for batch in batches for row in batch)
+        prices = [100, 150, 250] * 10
+        assert rows == [
+            (10, 40, math.floor(statistics.mean(prices)), math.floor(statistics.pstdev(prices)), 250, 100),
+            (11, 60, math.floor(statistics.mean([7, 20] * 10)), math.floor(statistics.pstdev([7, 20] * 10)), 20, 7)
+        ]
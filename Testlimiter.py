@@ -0,0 +1,32 @@
+import pytest
+from limiter import AdaptiveLimiter, isThrottled
+
+class TestLimiter():
+
+    @pytest.mark.parametrize(
+        "msg,expected",
+        [
+            ('Invalid response - https://us.api.blizzard.com/data/wow/item/19019 - 429', True),
+            ('HTTP Error 429: Too Many Requests', True),
+            ('Invalid response - https://us.api.blizzard.com/data/wow/item/429 - 404', False)
+        ])
+    def test_isThrottled(self, msg, expected):
+        '''Test 429 responses are told apart from other errors'''
+        assert isThrottled(Exception(msg)) == expected
+
+    def test_call_adapts_limit(self):
+        '''Test the limit grows on fast requests and halves on 429'''
+        limiter = AdaptiveLimiter(initial=4, minimum=1, maximum=8)
+        for i in range(20):
+            assert limiter.call(lambda x: x, i) == i
+        assert limiter.stats()['limit'] > 4
+        attempts = list()
+        def throttled():
+            attempts.append(True)
+            raise Exception('HTTP Error 429: Too Many Requests')
+        before = limiter.limit
+        with pytest.raises(Exception):
+            limiter.call(throttled, retries=0)
+        assert limiter.limit == before / 2
+        assert len(attempts) == 1
+        assert limiter.stats()['throttles'] == 1
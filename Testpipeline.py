@@ -0,0 +1,46 @@
+import pytest
+from pipeline import runPipeline
+
+listings = [{'id': i, 'item': {'id': i % 7}, 'quantity': 1, 'unit_price': i} for i in range(100)]
+
+def parse(x):
+    if x['unit_price'] % 10 == 0:
+        return None
+    return x['item']['id'], (x['item']['id'], x['unit_price'])
+
+class TestPipeline():
+
+    def test_runPipeline(self):
+        '''Test every parsed row is loaded and every item ID resolved once'''
+        loaded = list()
+        resolved = list()
+        def load(batches):
+            for rows in batches:
+                loaded.extend(rows)
+            return len(loaded)
+        count = runPipeline(iter(listings), parse, load, resolved.extend, batch_size=8, queue_size=2)
+        assert count == 90
+        assert sorted(loaded) == sorted(parse(x)[1] for x in listings if parse(x))
+        assert sorted(resolved) == list(range(7))
+
+    def test_runPipeline_producer_error(self):
+        '''Test a failing download aborts the load before it completes'''
+        completed = list()
+        def stream():
+            yield from listings[:20]
+            raise ValueError('download failed')
+        def load(batches):
+            for rows in batches:
+                pass
+            completed.append(True)
+        with pytest.raises(ValueError):
+            runPipeline(stream(), parse, load, lambda ids: None, batch_size=8, queue_size=2)
+        assert not completed
+
+    def test_runPipeline_load_error(self):
+        '''Test a failing load is raised once the pipeline ends'''
+        def load(batches):
+            next(iter(batches))
+            raise RuntimeError('load failed')
+        with pytest.raises(RuntimeError):
+            runPipeline(iter(listings), parse, load, lambda ids: None, batch_size=8, queue_size=2)
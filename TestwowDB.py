@@ -96,6 +96,12 @@ class TestwowDB():
         data = wow.findAuctions()
         assert 'id' in data[0].keys()
 
+    def test_streamCommodities(self):
+        '''Test streaming region-wide commodity auction results'''
+        wow = WowDB(locale, region, realm, client_id, client_secret)
+        listing = next(wow.streamCommodities())
+        assert all(k in listing.keys() for k in ('id', 'item', 'quantity', 'unit_price'))
+
     # def test_sortListings(self):
     #     '''Test sorting auction house results'''
     #     wow = WowDB(locale, region, realm, client_id, client_secret)
@@ -0,0 +1,271 @@
+from array import array
+from multiprocessing import Pool
+from welford import Welford
+import logging
+import math
+import queue as queue
+import threading
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+def findPrice(listing):
+    '''
+    Finds the unit price of the listing.
+
+    @param listing Listing of an item
+
+    @return unit_price of item
+    @return None returned if listing does not contain valid price
+    '''
+    if 'unit_price' in listing:
+        return listing['unit_price']
+    elif 'buyout' in listing:
+        return listing['buyout']/listing['quantity']
+    return
+
+def aggregateChunk(task):
+    '''
+    Computes per-item aggregates of a chunk of listings. The chunk is sent as
+    compact arrays rather than listing dictionaries, so the cost of sending it
+    to a worker process is small next to the aggregation itself. If the chunk
+    holds the whole shard the final rows are returned, otherwise the partial
+    aggregates are returned as plain tuples to be merged.
+
+    @param task Tuple (shard, item_ids, quantities, prices, chunks) of
+                chunkListings where the arrays hold one formatted listing per
+                index
+
+    @return Tuple (shard, rows, partials, chunks) where rows are the rows of
+            toRows if the chunk holds the whole shard and partials otherwise
+            maps item_id to (count, mean, S, quantity, high_price, low_price)
+    '''
+    shard, item_ids, quantities, prices, chunks = task
+    partials = dict()
+    for item_id, quantity, price in zip(item_ids, quantities, prices):
+        partial = partials.get(item_id)
+        if partial is None:
+            partials[item_id] = [Welford([price]), quantity, price, price]
+        else:
+            partial[0].update(price)
+            partial[1] += quantity
+            if price > partial[2]:
+                partial[2] = price
+            elif price < partial[3]:
+                partial[3] = price
+    if chunks == 1:
+        return shard, toRows(partials), None, chunks
+    return shard, None, {item_id: (w.k, w.M, w.S, quantity, high, low)
+        for item_id, (w, quantity, high, low) in partials.items()}, chunks
+
+def chunkListings(listings, invalid, num_shards, chunk_size, formatted_list=None, resolve=None, resolve_size=5000):
+    '''
+    Formats a stream of auction listings into compact arrays sharded by item
+    ID. A chunk of a shard is yielded as soon as it holds chunk_size listings,
+    so it can be aggregated while the rest of the stream is still being
+    downloaded and parsed, and the remaining listings of every shard are
+    yielded at the end of the stream. Listings with an invalid item ID or
+    without a price are dropped. Prices are rounded the same way Postgres
+    stores them in the (realm)_snapshot table.
+
+    @param listings Iterable of auction listings
+    @param invalid Collection of invalid item IDs to drop
+    @param num_shards Number of shards, listings are sharded by item ID
+    @param chunk_size Number of listings of a shard sent as one chunk
+    @param formatted_list List extended with tuples (item_id, quantity, price,
+                          auction_id) of the listings if given
+    @param resolve Callable called with each list of new item IDs, every
+                   resolve_size listings and before the last chunks are yielded
+    @param resolve_size Number of listings between calls of resolve
+
+    @return generator of tasks (shard, item_ids, quantities, prices, chunks)
+            where chunks is 0 except on the last chunk of a shard, where it
+            is the number of chunks the shard was sent in
+    '''
+    keep_listings = formatted_list is not None
+    def empty():
+        return array('q'), array('q'), array('q'), array('q') if keep_listings else None
+
+    def flush(shard, chunks):
+        item_ids, quantities, prices, auction_ids = shards[shard]
+        if keep_listings:
+            formatted_list.extend(zip(item_ids, quantities, prices, auction_ids))
+        shards[shard] = empty()
+        sent[shard] += 1
+        return shard, item_ids, quantities, prices, chunks
+
+    shards = [empty() for i in range(num_shards)]
+    sent = [0] * num_shards
+    seen = set()
+    new_ids = list()
+    for count, x in enumerate(listings, 1):
+        if resolve and new_ids and count % resolve_size == 0:
+            resolve(new_ids)
+            new_ids = list()
+        item_id = x['item']['id']
+        if item_id in invalid:
+            continue
+        price = findPrice(x)
+        if price is None:
+            continue
+        if resolve and item_id not in seen:
+            seen.add(item_id)
+            new_ids.append(item_id)
+        shard = item_id % num_shards
+        item_ids, quantities, prices, auction_ids = shards[shard]
+        item_ids.append(item_id)
+        quantities.append(x['quantity'])
+        prices.append(int(round(price)))
+        if keep_listings:
+            auction_ids.append(x['id'])
+        if len(item_ids) >= chunk_size:
+            yield flush(shard, 0)
+    if resolve and new_ids:
+        resolve(new_ids)
+    for shard in range(num_shards):
+        # A shard already sent in full still needs an empty last chunk to
+        # report its number of chunks
+        if len(shards[shard][0]) or sent[shard]:
+            yield flush(shard, sent[shard] + 1)
+
+def mergePartials(merged, partials):
+    '''
+    Merges partial per-item aggregates into merged.
+
+    @param merged Dictionary mapping item_id to [Welford of prices, quantity,
+                  high_price, low_price] to merge into
+    @param partials Dictionary of partial aggregates from aggregateChunk
+    '''
+    for item_id, (k, M, S, quantity, high, low) in partials.items():
+        w = Welford()
+        w.k, w.M, w.S = k, M, S
+        current = merged.get(item_id)
+        if current is None:
+            merged[item_id] = [w, quantity, high, low]
+        else:
+            current[0].merge(w)
+            current[1] += quantity
+            current[2] = max(current[2], high)
+            current[3] = min(current[3], low)
+
+def toRows(merged):
+    '''
+    Converts merged aggregates into rows of the (realm) table, matching the
+    statistics computed by dbConnect.insertNewListings.
+
+    @param merged Dictionary of merged aggregates
+
+    @return List of tuples (item_id, quantity, avg_unit_price, std_dev,
+            high_price, low_price) ordered by item_id
+    '''
+    return [(item_id, quantity, math.floor(w.mean), math.floor(w.std_pop), high, low)
+        for item_id, (w, quantity, high, low) in sorted(merged.items())]
+
+def aggregateListings(listings, invalid, processes, load, keep_listings=False, chunk_size=5000, num_shards=64, resolve=None):
+    '''
+    Aggregates a stream of auction listings per item with a pool of worker
+    processes. The listings are formatted by chunkListings in the pool's task
+    thread, so the workers aggregate every full chunk while the rest of the
+    stream is still being downloaded and parsed. Every item belongs to exactly
+    one shard, and the partial aggregates of the chunks of a shard are merged
+    with Welford.merge. As soon as every chunk of a shard is merged its rows
+    are handed to load, which runs in a separate thread, so bulk loading
+    overlaps with the aggregation of the remaining shards.
+
+    @param listings Iterable of auction listings, for example
+                    WowDB.streamAuctions
+    @param invalid Collection of invalid item IDs to drop
+    @param processes Number of worker processes
+    @param load Callable consuming an iterable of lists of rows, for example
+                dbConnect.storeAggregates
+    @param keep_listings Also return the formatted listings, with auction IDs,
+                         for the (realm)_snapshot table
+    @param chunk_size Number of listings sent to a worker at a time
+    @param num_shards Minimum number of shards. Many small shards keep the
+                      number of partial aggregates to merge low.
+    @param resolve Callable called with each list of new item IDs while the
+                   listings are parsed. Every call is made before the first
+                   batch of rows reaches load.
+
+    @return formatted_list List of tuples (item_id, quantity, price,
+            auction_id) if keep_listings is set
+    @return None returned otherwise
+
+    @throws Exception Thrown when any exception is caught in the stream, a
+                      worker or load
+    '''
+    num_shards = max(processes * 4, num_shards)
+    formatted_list = list() if keep_listings else None
+    tasks = chunkListings(listings, frozenset(invalid), num_shards, chunk_size, formatted_list, resolve)
+
+    batches = queue.Queue(maxsize=num_shards)
+    errors = list()
+
+    def nextBatch():
+        for batch in iter(batches.get, None):
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+
+    def loader():
+        try:
+            load(nextBatch())
+        except Exception as e:
+            errors.append(e)
+            # Keep draining so the producer never blocks on a full queue
+            for batch in iter(batches.get, None):
+                pass
+
+    load_thread = threading.Thread(target=loader)
+    load_thread.start()
+    merged = dict()
+    received = dict()
+    expected = dict()
+    count = 0
+    try:
+        with Pool(processes) as pool:
+            for shard, rows, partials, chunks in pool.imap_unordered(aggregateChunk, tasks):
+                count += 1
+                if errors:
+                    break
+                if rows is not None:
+                    batches.put(rows)
+                    continue
+                mergePartials(merged.setdefault(shard, dict()), partials)
+                received[shard] = received.get(shard, 0) + 1
+                if chunks:
+                    expected[shard] = chunks
+                if received[shard] == expected.get(shard):
+                    batches.put(toRows(merged.pop(shard)))
+    except Exception as e:
+        # Abort the load so no partial hour is committed
+        batches.put(e)
+        raise e
+    finally:
+        batches.put(None)
+        load_thread.join()
+    if errors:
+        raise errors[0]
+    logging.debug('Aggregated %d tasks in %d shards with %d processes' % (count, num_shards, processes))
+    return formatted_list
+
+def benchAggregate(count=600000, processes=1, items=20000):
+    '''
+    Measures the throughput of aggregateListings on synthetic listings.
+
+    @param count Number of listings
+    @param processes Number of worker processes
+    @param items Number of distinct item IDs
+
+    @return Tuple (seconds, listings per second)
+    '''
+    import random
+    import time
+
+    rng = random.Random(0)
+    data = [{'id': i, 'item': {'id': rng.randrange(items)}, 'quantity': rng.randrange(1, 20),
+        'buyout': rng.randrange(1, 10 ** 7)} for i in range(count)]
+    start_time = time.perf_counter()
+    aggregateListings(data, (), processes, lambda batches: [b for b in batches])
+    elapsed = time.perf_counter() - start_time
+    return elapsed, count / elapsed
@@ -3,11 +3,13 @@ from psycopg2 import pool,sql
 from psycopg2.extras import execute_values
 from configparser import ConfigParser
 import logging
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
-def config(filename = 'settings.ini', section='wowdb'):
+def config(filename = 'settings.ini', section='wowdb', required=True):
     '''
     Code for config found here:
     https://www.postgresqltutorial.com/postgresql-python/connect/
@@ -15,10 +17,11 @@ def config(filename = 'settings.ini', section='wowdb'):
 
     @param filename File to open
     @param Section in file to store
+    @param required If False, a missing section returns an empty dictionary
 
     @return db Dictionary containing parsed database info
 
-    @throws Exception thrown if specific section is not found in config file
+    @throws Exception thrown if a required section is not found in config file
     '''
     parser = ConfigParser()
     parser.read(filename)
@@ -28,41 +31,143 @@ def config(filename = 'settings.ini', section='wowdb'):
         params = parser.items(section)
         for param in params:
             db[param[0]] = param[1]
+    elif not required:
+        logging.debug('Section {0} not found in the {1} file, using defaults'.format(section, filename))
     else:
         msg = 'Section {0} not found in the {1} file'.format(section, filename)
         logging.exception(msg)
         raise Exception(msg)
     return db
 
+class KeepAlivePool(pool.ThreadedConnectionPool):
+    '''
+    Thread safe pool that opens connections on demand and keeps every returned
+    connection open for reuse up to maxconn. ThreadedConnectionPool closes a
+    returned connection once minconn connections are idle, so connections
+    above minconn would be opened and closed on every checkout.
+    '''
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        self.opened = 0
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        # putconn keeps returned connections while fewer than minconn are idle
+        self.minconn = self.maxconn
+
+    def _connect(self, key=None):
+        self.opened += 1
+        return super()._connect(key)
+
 class dbConnect():
     '''
-    Class to connect with DB and execute queries specific to wowDB
+    Class to connect with DB and execute queries specific to wowDB. The number
+    of connections checked out at once is capped by a semaphore shared by every
+    instance in the process, so several realms can never exceed the cap.
     '''
+    conn_slots = None
+    max_connections = None
+    slots_lock = threading.Lock()
+
     def __init__(self):
         self.conn_pool = None
+        self.stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
 
     def __del__(self):
-        self.conn_pool.closeall()
+        if self.conn_pool:
+            self.conn_pool.closeall()
+        # Give back the slots of connections that were never returned
+        for i in range(self.in_use):
+            dbConnect.conn_slots.release()
 
-    def connect(self, host, database, port, user, password):
+    def connect(self, host, database, port, user, password, max_connections=20):
         '''
-        Connect to database using details within settings.ini
-        
+        Connect to database using details within settings.ini. Connections
+        are opened on demand and kept open once returned, so the pool only
+        grows as large as the work running concurrently, up to max_connections. The first call in the
+        process sets the cap shared by all instances. At least 2 connections
+        are required, since a snapshot load holds one for the whole download
+        while item lookups need another.
+
+        @param max_connections Maximum number of connections of the process
+
+        @throws ValueError Thrown if max_connections is less than 2
         @throws Error Thrown if connection fails
         @throws Exception Thrown when any other exception is caught
         '''
         try:
-            self.conn_pool = psycopg2.pool.ThreadedConnectionPool(5,100,host=host,database=database,user=user,password=password,port=port)
+            if int(max_connections) < 2:
+                raise ValueError('max_connections must be at least 2, got %s' % max_connections)
+            with dbConnect.slots_lock:
+                if dbConnect.conn_slots is None:
+                    dbConnect.max_connections = int(max_connections)
+                    dbConnect.conn_slots = threading.BoundedSemaphore(dbConnect.max_connections)
+            self.conn_pool = KeepAlivePool(1,dbConnect.max_connections,host=host,database=database,user=user,password=password,port=port)
             logging.debug("Connected to database {0} at {1} port {2}".format(database, host, port))
         except (Exception, psycopg2.Error) as e:
             logging.exception(str(e))
             raise e
 
+    def getConn(self):
+        '''
+        Checks out a connection from the pool, waiting while the process-wide
+        cap is reached.
+
+        @return connection
+
+        @throws Error Thrown if a new connection cannot be opened
+        '''
+        start_time = time.perf_counter()
+        dbConnect.conn_slots.acquire()
+        waited = time.perf_counter() - start_time
+        try:
+            conn = self.conn_pool.getconn()
+        except Exception as e:
+            dbConnect.conn_slots.release()
+            raise e
+        with self.stats_lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        return conn
+
+    def putConn(self, conn):
+        '''
+        Returns a connection checked out with getConn to the pool.
+
+        @param conn connection to return
+        '''
+        self.conn_pool.putconn(conn)
+        with self.stats_lock:
+            self.in_use -= 1
+        dbConnect.conn_slots.release()
+
+    def poolStats(self):
+        '''
+        Gets the connection pool statistics of this instance.
+
+        @return Dictionary with checkouts, connections opened, in_use,
+                peak_in_use, wait_total and wait_max (seconds), and the
+                process-wide max_connections
+        '''
+        with self.stats_lock:
+            opened = self.conn_pool.opened if self.conn_pool else 0
+            return {'checkouts': self.checkouts, 'opened': opened, 'in_use': self.in_use, 'peak_in_use': self.peak_in_use,
+                'wait_total': self.wait_total, 'wait_max': self.wait_max, 'max_connections': dbConnect.max_connections}
+
     def checkTableExists(self, realm_slug):
         '''
         Checks if a table of desired realm exists. If the table does
         not exist, creates the table with the name according to the
         realm_slug. Also creates table item_list if it does not exist.
+        Rows of the realm table are tagged with the bucket they cover
+        ('hour', 'day' or 'week') so that applyRetention can downsample them.
+        Table (realm)_latest holds one row per item with its latest stats and
+        table realm_index holds the latest ingested hour of every realm.
         
         @param realm_slug Name of table to look for
         
@@ -71,7 +176,7 @@ class dbConnect():
         '''
         try:
             self.realm = realm_slug.replace('-','_')
-            local_conn = self.conn_pool.getconn()
+            local_conn = self.getConn()
             if local_conn:
                 cur = local_conn.cursor()
                 cur.execute(sql.SQL(
@@ -90,21 +195,192 @@ class dbConnect():
                         item_name TEXT NOT NULL,
                         item_pic BYTEA NOT NULL
                     );
+                    CREATE TABLE IF NOT EXISTS realm_index (
+                        realm TEXT PRIMARY KEY,
+                        latest_interval TIMESTAMP NOT NULL
+                    );
                     CREATE TABLE IF NOT EXISTS {} (
                         item_id INTEGER NOT NULL,
                         quantity INTEGER NOT NULL,
                         price BIGINT NOT NULL
                     );
-                    """).format(sql.Identifier(self.realm), sql.Identifier(self.realm + '_snapshot')),[]
+                    CREATE TABLE IF NOT EXISTS {} (
+                        item_id INTEGER PRIMARY KEY,
+                        interval TIMESTAMP NOT NULL,
+                        quantity INTEGER NOT NULL,
+                        avg_unit_price BIGINT NOT NULL,
+                        std_dev BIGINT NOT NULL,
+                        high_price BIGINT NOT NULL,
+                        low_price BIGINT NOT NULL,
+                        price_change_24h BIGINT,
+                        price_change_7d BIGINT
+                    );
+                    """).format(sql.Identifier(self.realm), sql.Identifier(self.realm + '_snapshot'),
+                        sql.Identifier(self.realm + '_latest')),[]
                 )
+                # Migrations lock the table even if there is nothing to do,
+                # so they only run when needed
+                if not self.__columnExists(cur, self.realm, 'bucket'):
+                    cur.execute(sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS bucket TEXT NOT NULL DEFAULT 'hour'").format(
+                        sql.Identifier(self.realm)), [])
+                if not self.__indexExists(cur, self.realm + '_interval_idx'):
+                    cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} (interval)").format(
+                        sql.Identifier(self.realm + '_interval_idx'), sql.Identifier(self.realm)), [])
                 local_conn.commit()
                 cur.close()
-                self.conn_pool.putconn(local_conn)
+                self.putConn(local_conn)
                 logging.debug("Created table %s and table item_list" % self.realm)
         except (Exception, psycopg2.Error) as e:
             logging.exception(str(e))
             raise e
 
+    def __columnExists(self, cur, table, column):
+        '''
+        Checks if a table has a column. Used to run migrations only once, since
+        ALTER TABLE locks the table even if the column already exists.
+
+        @param cur Cursor to query with
+        @param table Name of the table
+        @param column Name of the column
+
+        @return true/false
+        '''
+        cur.execute(
+            """
+            SELECT EXISTS (
+                SELECT *
+                FROM information_schema.columns
+                WHERE table_schema = CURRENT_SCHEMA() AND table_name = %s AND column_name = %s
+            )
+            """,
+            (table, column)
+        )
+        return cur.fetchone()[0]
+
+    def __indexExists(self, cur, index):
+        '''
+        Checks if an index exists. Used to create indexes only once, since
+        CREATE INDEX locks the table even if the index already exists.
+
+        @param cur Cursor to query with
+        @param index Name of the index
+
+        @return true/false
+        '''
+        cur.execute(
+            """
+            SELECT EXISTS (
+                SELECT *
+                FROM pg_indexes
+                WHERE schemaname = CURRENT_SCHEMA() AND indexname = %s
+            )
+            """,
+            (index,)
+        )
+        return cur.fetchone()[0]
+
+    def checkDeltaTablesExist(self):
+        '''
+        Creates the tables used for listing-level delta tracking if they do
+        not exist. Table (realm)_listings holds the auction IDs of the previous
+        snapshot and table (realm)_deltas holds the per-item counts of new and
+        disappeared listings. Also adds column auction_id to the
+        (realm)_snapshot table and index (realm)_deltas_interval_idx used by
+        applyDeltaRetention if they are missing, and drops column
+        repriced_listings of tables created by earlier versions.
+        checkTableExists must be called first.
+
+        @throws Error Thrown if error in any database calls
+        @throws Exception Thrown when any other exception is caught
+        '''
+        try:
+            local_conn = self.getConn()
+            if local_conn:
+                cur = local_conn.cursor()
+                cur.execute(sql.SQL(
+                    """
+                    CREATE TABLE IF NOT EXISTS {} (
+                        auction_id BIGINT PRIMARY KEY,
+                        item_id INTEGER NOT NULL,
+                        price BIGINT NOT NULL
+                    );
+                    CREATE TABLE IF NOT EXISTS {} (
+                        interval TIMESTAMP NOT NULL DEFAULT DATE_TRUNC('hour', NOW()),
+                        item_id INTEGER NOT NULL,
+                        new_listings INTEGER NOT NULL,
+                        disappeared_listings INTEGER NOT NULL,
+                        bucket TEXT NOT NULL DEFAULT 'hour'
+                    );
+                    """).format(sql.Identifier(self.realm + '_listings'), sql.Identifier(self.realm + '_deltas')),[]
+                )
+                if not self.__columnExists(cur, self.realm + '_snapshot', 'auction_id'):
+                    cur.execute(sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS auction_id BIGINT").format(
+                        sql.Identifier(self.realm + '_snapshot')), [])
+                if not self.__columnExists(cur, self.realm + '_deltas', 'bucket'):
+                    cur.execute(sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS bucket TEXT NOT NULL DEFAULT 'hour'").format(
+                        sql.Identifier(self.realm + '_deltas')), [])
+                if not self.__indexExists(cur, self.realm + '_deltas_interval_idx'):
+                    cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} (interval)").format(
+                        sql.Identifier(self.realm + '_deltas_interval_idx'), sql.Identifier(self.realm + '_deltas')), [])
+                if self.__columnExists(cur, self.realm + '_deltas', 'repriced_listings'):
+                    # The buyout of an auction never changes, so the column was always 0
+                    cur.execute(sql.SQL("ALTER TABLE {} DROP COLUMN IF EXISTS repriced_listings").format(
+                        sql.Identifier(self.realm + '_deltas')), [])
+                local_conn.commit()
+                cur.close()
+                self.putConn(local_conn)
+                logging.debug("Created delta tables for %s" % self.realm)
+        except (Exception, psycopg2.Error) as e:
+            logging.exception(str(e))
+            raise e
+
+    def checkCommodityTablesExist(self, region):
+        '''
+        Checks if the commodity tables of the region exist and creates them if
+        they do not. Commodities are traded on a single region-wide auction
+        house, so table commodities_(region) and table
+        commodities_(region)_snapshot are shared by all realms of the region.
+
+        @param region Region of the commodity auction house
+
+        @throws Error Thrown if error any of the database calls
+        @throws Exception Thrown when any other exception is caught
+        '''
+        try:
+            self.commodities = 'commodities_' + region
+            local_conn = self.getConn()
+            if local_conn:
+                cur = local_conn.cursor()
+                cur.execute(sql.SQL(
+                    """
+                    CREATE TABLE IF NOT EXISTS {} (
+                        interval TIMESTAMP NOT NULL DEFAULT DATE_TRUNC('hour', NOW()),
+                        item_id INTEGER NOT NULL,
+                        quantity INTEGER NOT NULL,
+                        avg_unit_price BIGINT NOT NULL,
+                        std_dev BIGINT NOT NULL,
+                        high_price BIGINT NOT NULL,
+                        low_price BIGINT NOT NULL,
+                        bucket TEXT NOT NULL DEFAULT 'hour'
+                    );
+                    CREATE TABLE IF NOT EXISTS {} (
+                        item_id INTEGER NOT NULL,
+                        quantity INTEGER NOT NULL,
+                        price BIGINT NOT NULL
+                    );
+                    """).format(sql.Identifier(self.commodities), sql.Identifier(self.commodities + '_snapshot')),[]
+                )
+                if not self.__indexExists(cur, self.commodities + '_interval_idx'):
+                    cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} (interval)").format(
+                        sql.Identifier(self.commodities + '_interval_idx'), sql.Identifier(self.commodities)), [])
+                local_conn.commit()
+                cur.close()
+                self.putConn(local_conn)
+                logging.debug("Created table %s" % self.commodities)
+        except (Exception, psycopg2.Error) as e:
+            logging.exception(str(e))
+            raise e
+
     def checkItemExists(self, item_id):
         '''
         Checks if the item already exists in the table item_list.
@@ -117,7 +393,7 @@ class dbConnect():
         @throws Exception Thrown when any other exception is caught
         '''
         try:
-            local_conn = self.conn_pool.getconn()
+            local_conn = self.getConn()
             if local_conn:
                 cur = local_conn.cursor()
                 cur.execute(
@@ -132,7 +408,7 @@ class dbConnect():
                 )
                 res = cur.fetchone()[0]
                 cur.close()
-                self.conn_pool.putconn(local_conn)
+                self.putConn(local_conn)
                 return res
         except (Exception, psycopg2.Error) as e:
             logging.exception(str(e))
@@ -150,7 +426,7 @@ class dbConnect():
         @throws Exception Thrown when any other exception is caught
         '''
         try:
-            local_conn = self.conn_pool.getconn()
+            local_conn = self.getConn()
             if local_conn:
                 cur = local_conn.cursor()
                 cur.execute(
@@ -169,7 +445,7 @@ class dbConnect():
                 )
                 local_conn.commit()
                 cur.close()
-                self.conn_pool.putconn(local_conn)
+                self.putConn(local_conn)
                 logging.debug("Storing item %s name and picture in table item_list" % item_id)
         except (Exception, psycopg2.Error) as e:
             logging.exception(str(e))
@@ -187,14 +463,67 @@ class dbConnect():
         @throws Exception Thrown when any other exception is caught
         '''
         try:
-            local_conn = self.conn_pool.getconn()
+            local_conn = self.getConn()
             cur = local_conn.cursor()
             temp = [("(" + str(x) + ")") for x in id_list]
             temp_str = ','.join(i for i in temp)
             cur.execute("SELECT id FROM (VALUES %s) V(id) EXCEPT SELECT item_id FROM item_list ORDER BY id" % temp_str)
             res = [r[0] for r in cur.fetchall()]
             cur.close()
-            self.conn_pool.putconn(local_conn)
+            self.putConn(local_conn)
+            return res
+        except (Exception, psycopg2.Error) as e:
+            logging.exception(str(e))
+            raise e
+
+    def getMissingItemIDs(self):
+        '''
+        Gets a list of item IDs in the (realm) table that do not appear in the
+        table item_list.
+
+        @return res List of IDs that are not present
+
+        @throws Error Thrown if error in any database calls
+        @throws Exception Thrown when any other exception is caught
+        '''
+        try:
+            local_conn = self.getConn()
+            cur = local_conn.cursor()
+            cur.execute(sql.SQL(
+                """
+                SELECT DISTINCT item_id FROM {} EXCEPT SELECT item_id FROM item_list ORDER BY item_id
+                """).format(sql.Identifier(self.realm)),[]
+            )
+            res = [r[0] for r in cur.fetchall()]
+            cur.close()
+            self.putConn(local_conn)
+            return res
+        except (Exception, psycopg2.Error) as e:
+            logging.exception(str(e))
+            raise e
+
+    def getRealms(self):
+        '''
+        Gets the realm tables that have been ingested, from table realm_index,
+        without calling the Battle.net API. checkTableExists can be called
+        with each of them to select its tables.
+
+        @return res List of realm table names ordered by name, empty if no
+                realm has been ingested yet
+
+        @throws Error Thrown if error in any database calls
+        @throws Exception Thrown when any other exception is caught
+        '''
+        try:
+            local_conn = self.getConn()
+            cur = local_conn.cursor()
+            cur.execute("SELECT TO_REGCLASS('realm_index') IS NOT NULL", [])
+            res = list()
+            if cur.fetchone()[0]:
+                cur.execute("SELECT realm FROM realm_index ORDER BY realm", [])
+                res = [r[0] for r in cur.fetchall()]
+            cur.close()
+            self.putConn(local_conn)
             return res
         except (Exception, psycopg2.Error) as e:
             logging.exception(str(e))
@@ -210,7 +539,7 @@ class dbConnect():
         @throws Exception Thrown when any other exception is caught
         '''
         try:
-            local_conn = self.conn_pool.getconn()
+            local_conn = self.getConn()
             cur = local_conn.cursor()
             columns = formatted_list[0].keys()
             query = "INSERT INTO {} ({}) VALUES %s".format(self.realm + '_snapshot', ','.join(columns))
@@ -218,11 +547,96 @@ class dbConnect():
             execute_values(cur, query, values)
             local_conn.commit()
             cur.close()
-            self.conn_pool.putconn(local_conn)
+            self.putConn(local_conn)
         except (Exception, psycopg2.Error) as e:
             logging.exception(str(e))
             raise e
 
+    def loadSnapshot(self, batches, columns):
+        '''
+        Replaces the (realm)_snapshot table with the given batches of listings.
+        Batches are inserted as they arrive in a single transaction, so the
+        load can start before the whole auction house is parsed.
+
+        If a batch or the iterator raises, the transaction is rolled back and
+        the connection returned to the pool.
+
+        @param batches Iterable of lists of tuples holding the given columns
+        @param columns Names of the columns of each tuple
+
+        @return count Number of listings stored
+
+        @throws Error Thrown if error in any database calls
+        @throws Exception Thrown when any other exception is caught
+        '''
+        try:
+            local_conn = self.getConn()
+        except (Exception, psycopg2.Error) as e:
+            logging.exception(str(e))
+            raise e
+        try:
+            cur = local_conn.cursor()
+            cur.execute(sql.SQL("TRUNCATE {}").format(sql.Identifier(self.realm + '_snapshot')), [])
+            query = sql.SQL("INSERT INTO {} ({}) VALUES %s").format(sql.Identifier(self.realm + '_snapshot'),
+                sql.SQL(',').join(map(sql.Identifier, columns))).as_string(cur)
+            count = 0
+            for rows in batches:
+                execute_values(cur, query, rows, page_size=1000)
+                count += len(rows)
+            local_conn.commit()
+            cur.close()
+            logging.debug("Stored %d listings in table %s" % (count, self.realm + '_snapshot'))
+            return count
+        except (Exception, psycopg2.Error) as e:
+            # Aborting releases the TRUNCATE lock and discards the partial load
+            if not local_conn.closed:
+                local_conn.rollback()
+            logging.exception(str(e))
+            raise e
+        finally:
+            self.putConn(local_conn)
+
+    def storeAggregates(self, batches):
+        '''
+        Inserts rows of already analyzed listings into table (realm). All
+        batches are inserted and table (realm)_latest is updated in a single
+        transaction, so either the whole hour is stored or nothing is.
+
+        If a batch or the iterator raises, the transaction is rolled back and
+        the connection returned to the pool.
+
+        @param batches Iterable of lists of tuples (item_id, quantity,
+                       avg_unit_price, std_dev, high_price, low_price)
+
+        @throws Error Thrown if error in any database calls
+        @throws Exception Thrown when any other exception is caught
+        '''
+        try:
+            local_conn = self.getConn()
+        except (Exception, psycopg2.Error) as e:
+            logging.exception(str(e))
+            raise e
+        try:
+            cur = local_conn.cursor()
+            query = sql.SQL("INSERT INTO {} (item_id, quantity, avg_unit_price, std_dev, high_price, low_price) VALUES %s").format(
+                sql.Identifier(self.realm)).as_string(cur)
+            count = 0
+            for rows in batches:
+                execute_values(cur, query, rows, page_size=1000)
+                count += len(rows)
+            self.__upsertLatest(cur)
+            local_conn.commit()
+            cur.close()
+            logging.debug("Inserting %d aggregated rows to table %s" % (count, self.realm))
+        except (Exception, psycopg2.Error) as e:
+            # Aborting discards the partial hour
+            if not local_conn.closed:
+                local_conn.rollback()
+            logging.exception(str(e))
+            raise e
+        finally:
+            self.putConn(local_conn)
+
     def clearSnapshot(self):
         '''
         Clears the (realm)_snapshot table.
@@ -231,7 +645,7 @@ class dbConnect():
         @throws Exception Thrown when any other exception is caught
         '''
         try:
-            local_conn = self.conn_pool.getconn()
+            local_conn = self.getConn()
             if local_conn:
                 cur = local_conn.cursor()
                 cur.execute(sql.SQL(
@@ -241,7 +655,7 @@ class dbConnect():
                 )
                 local_conn.commit()
                 cur.close()
-                self.conn_pool.putconn(local_conn)
+                self.putConn(local_conn)
                 logging.debug("Clearing snap shot for %s" % self.realm)
         except (Exception, psycopg2.Error) as e:
             logging.exception(str(e))
@@ -249,26 +663,379 @@ class dbConnect():
 
     def insertNewListings(self):
         '''
-        Uses query statement to determine analyze snapshot and insert into table (realm)
+        Uses query statement to determine analyze snapshot and insert into table (realm).
+        Items missing from table item_list are invalid and left out. Table
+        (realm)_latest is updated in the same transaction.
 
         @throws Error Thrown if error in any database calls
         @throws Exception Thrown when any other exception is caught
         '''
         try:
-            local_conn = self.conn_pool.getconn()
+            local_conn = self.getConn()
             if local_conn:
                 cur = local_conn.cursor()
                 cur.execute(sql.SQL(
                     """
                     INSERT INTO {} (item_id, quantity, avg_unit_price, std_dev, high_price, low_price)
                         SELECT item_id, SUM(quantity), FLOOR(AVG(price)), FLOOR(STDDEV_POP(price)), MAX(price), MIN(price)
-                        FROM {} GROUP BY item_id ORDER BY item_id
+                        FROM {} WHERE item_id IN (SELECT item_id FROM item_list) GROUP BY item_id ORDER BY item_id
                     """).format(sql.Identifier(self.realm), sql.Identifier(self.realm + '_snapshot')),[]
                 )
+                self.__upsertLatest(cur)
                 local_conn.commit()
                 cur.close()
-                self.conn_pool.putconn(local_conn)
+                self.putConn(local_conn)
                 logging.debug("Inserting analyzed data to table %s" % self.realm)
         except (Exception, psycopg2.Error) as e:
             logging.exception(str(e))
-            raise e
\ No newline at end of file
+            raise e
+
+    def __upsertLatest(self, cur):
+        '''
+        Copies the rows inserted into table (realm) this hour into table
+        (realm)_latest, together with the change of the average price since
+        24 hours and 7 days ago. Items missing this hour keep their previous
+        row. Also records this hour as the latest hour of the realm in table
+        realm_index. Must run in the transaction that inserted the rows.
+
+        @param cur Cursor of the inserting transaction
+        '''
+        cur.execute(sql.SQL(
+            """
+            INSERT INTO {latest} AS l (item_id, interval, quantity, avg_unit_price, std_dev, high_price, low_price,
+                    price_change_24h, price_change_7d)
+                SELECT DISTINCT ON (n.item_id) n.item_id, n.interval, n.quantity, n.avg_unit_price, n.std_dev,
+                    n.high_price, n.low_price, n.avg_unit_price - d.avg_unit_price, n.avg_unit_price - w.avg_unit_price
+                FROM {realm} n
+                LEFT JOIN {realm} d ON d.item_id = n.item_id AND d.bucket = 'hour'
+                    AND d.interval = DATE_TRUNC('hour', NOW()) - INTERVAL '24 hours'
+                LEFT JOIN {realm} w ON w.item_id = n.item_id AND w.bucket = 'hour'
+                    AND w.interval = DATE_TRUNC('hour', NOW()) - INTERVAL '7 days'
+                WHERE n.bucket = 'hour' AND n.interval = DATE_TRUNC('hour', NOW())
+                ORDER BY n.item_id
+            ON CONFLICT (item_id) DO UPDATE SET interval = EXCLUDED.interval, quantity = EXCLUDED.quantity,
+                avg_unit_price = EXCLUDED.avg_unit_price, std_dev = EXCLUDED.std_dev,
+                high_price = EXCLUDED.high_price, low_price = EXCLUDED.low_price,
+                price_change_24h = EXCLUDED.price_change_24h, price_change_7d = EXCLUDED.price_change_7d
+            """).format(latest=sql.Identifier(self.realm + '_latest'), realm=sql.Identifier(self.realm)),[]
+        )
+        cur.execute(
+            """
+            INSERT INTO realm_index (realm, latest_interval) VALUES (%s, DATE_TRUNC('hour', NOW()))
+            ON CONFLICT (realm) DO UPDATE SET latest_interval = EXCLUDED.latest_interval
+            """,
+            (self.realm,)
+        )
+
+    def getLatest(self, item_id):
+        '''
+        Gets the latest stats of an item from table (realm)_latest.
+
+        @param item_id ID of the item
+
+        @return Dictionary with interval, quantity, avg_unit_price, std_dev,
+                high_price, low_price, price_change_24h and price_change_7d
+        @return None returned if the item was never listed
+
+        @throws Error Thrown if error in any database calls
+        @throws Exception Thrown when any other exception is caught
+        '''
+        try:
+            local_conn = self.getConn()
+            cur = local_conn.cursor()
+            cur.execute(sql.SQL(
+                """
+                SELECT interval, quantity, avg_unit_price, std_dev, high_price, low_price, price_change_24h, price_change_7d
+                FROM {} WHERE item_id = %s
+                """).format(sql.Identifier(self.realm + '_latest')),
+                (item_id,)
+            )
+            row = cur.fetchone()
+            res = dict(zip([c[0] for c in cur.description], row)) if row else None
+            cur.close()
+            self.putConn(local_conn)
+            return res
+        except (Exception, psycopg2.Error) as e:
+            logging.exception(str(e))
+            raise e
+
+    def insertListingDeltas(self):
+        '''
+        Compares the auction IDs in the (realm)_snapshot table against those of
+        the previous snapshot in (realm)_listings and inserts the per-item counts
+        of new and disappeared listings into (realm)_deltas. The comparison is
+        a single full outer join on auction_id, which Postgres runs as a hash
+        join so it stays linear in snapshot size. Auction IDs are unique within
+        a snapshot, so no sort is needed to deduplicate them. The current
+        snapshot then replaces the previous one in the same transaction. No
+        deltas are recorded on the first run since there is nothing to compare.
+
+        @throws Error Thrown if error in any database calls
+        @throws Exception Thrown when any other exception is caught
+        '''
+        try:
+            local_conn = self.getConn()
+            if local_conn:
+                cur = local_conn.cursor()
+                cur.execute(sql.SQL(
+                    """
+                    INSERT INTO {deltas} (item_id, new_listings, disappeared_listings)
+                        SELECT COALESCE(cur.item_id, prev.item_id),
+                            COUNT(*) FILTER (WHERE prev.auction_id IS NULL),
+                            COUNT(*) FILTER (WHERE cur.auction_id IS NULL)
+                        FROM (SELECT auction_id, item_id
+                            FROM {snapshot} WHERE auction_id IS NOT NULL
+                                AND item_id IN (SELECT item_id FROM item_list)) cur
+                        FULL OUTER JOIN {listings} prev ON cur.auction_id = prev.auction_id
+                        WHERE EXISTS (SELECT 1 FROM {listings})
+                        GROUP BY COALESCE(cur.item_id, prev.item_id)
+                        ORDER BY 1;
+                    TRUNCATE {listings};
+                    INSERT INTO {listings} (auction_id, item_id, price)
+                        SELECT auction_id, item_id, price
+                        FROM {snapshot} WHERE auction_id IS NOT NULL
+                            AND item_id IN (SELECT item_id FROM item_list)
+                        ON CONFLICT (auction_id) DO NOTHING;
+                    """).format(deltas=sql.Identifier(self.realm + '_deltas'),
+                        snapshot=sql.Identifier(self.realm + '_snapshot'),
+                        listings=sql.Identifier(self.realm + '_listings')),[]
+                )
+                local_conn.commit()
+                cur.close()
+                self.putConn(local_conn)
+                logging.debug("Inserting listing deltas to table %s" % (self.realm + '_deltas'))
+        except (Exception, psycopg2.Error) as e:
+            logging.exception(str(e))
+            raise e
+
+    def storeCommodities(self, listings, batch_size=10000):
+        '''
+        Replaces the commodities_(region)_snapshot table with the given
+        listings. Listings are consumed and inserted batch_size at a time, so
+        only one batch is held in memory. The snapshot is replaced in a single
+        transaction. checkCommodityTablesExist must be called first.
+
+        If the download fails, the transaction is rolled back and the
+        connection returned to the pool.
+
+        @param listings Iterable of commodity listings
+        @param batch_size Number of listings inserted at a time
+
+        @return ids Set of item IDs seen in the listings
+
+        @throws Error Thrown if error in any database calls
+        @throws Exception Thrown when any other exception is caught
+        '''
+        try:
+            local_conn = self.getConn()
+        except (Exception, psycopg2.Error) as e:
+            logging.exception(str(e))
+            raise e
+        try:
+            cur = local_conn.cursor()
+            cur.execute(sql.SQL("TRUNCATE {}").format(sql.Identifier(self.commodities + '_snapshot')), [])
+            query = sql.SQL("INSERT INTO {} (item_id, quantity, price) VALUES %s").format(
+                sql.Identifier(self.commodities + '_snapshot')).as_string(cur)
+            ids = set()
+            batch = list()
+            count = 0
+            for x in listings:
+                if 'unit_price' not in x:
+                    continue
+                ids.add(x['item']['id'])
+                batch.append((x['item']['id'], x['quantity'], x['unit_price']))
+                if len(batch) >= batch_size:
+                    execute_values(cur, query, batch, page_size=batch_size)
+                    count += len(batch)
+                    batch = list()
+            if batch:
+                execute_values(cur, query, batch, page_size=batch_size)
+                count += len(batch)
+            local_conn.commit()
+            cur.close()
+            logging.debug("Stored %d listings in table %s" % (count, self.commodities + '_snapshot'))
+            return ids
+        except (Exception, psycopg2.Error) as e:
+            # Aborting releases the TRUNCATE lock and discards the partial load
+            if not local_conn.closed:
+                local_conn.rollback()
+            logging.exception(str(e))
+            raise e
+        finally:
+            self.putConn(local_conn)
+
+    def insertCommodityListings(self):
+        '''
+        Analyzes the commodities_(region)_snapshot table and inserts the result
+        into table commodities_(region). Items missing from table item_list
+        are invalid and left out.
+
+        @throws Error Thrown if error in any database calls
+        @throws Exception Thrown when any other exception is caught
+        '''
+        try:
+            local_conn = self.getConn()
+            if local_conn:
+                cur = local_conn.cursor()
+                cur.execute(sql.SQL(
+                    """
+                    INSERT INTO {} (item_id, quantity, avg_unit_price, std_dev, high_price, low_price)
+                        SELECT item_id, SUM(quantity), FLOOR(AVG(price)), FLOOR(STDDEV_POP(price)), MAX(price), MIN(price)
+                        FROM {} WHERE item_id IN (SELECT item_id FROM item_list) GROUP BY item_id ORDER BY item_id
+                    """).format(sql.Identifier(self.commodities), sql.Identifier(self.commodities + '_snapshot')),[]
+                )
+                local_conn.commit()
+                cur.close()
+                self.putConn(local_conn)
+                logging.debug("Inserting analyzed data to table %s" % self.commodities)
+        except (Exception, psycopg2.Error) as e:
+            logging.exception(str(e))
+            raise e
+
+    def applyRetention(self, hourly_days, daily_days, table=None):
+        '''
+        Downsamples aged rows of the (realm) table. Hourly rows older than
+        hourly_days are merged into daily rows and daily rows older than
+        daily_days are merged into weekly rows. Weekly rows are kept forever.
+        checkTableExists must be called first unless table is given.
+
+        @param hourly_days Number of days to keep hourly rows
+        @param daily_days Number of days to keep daily rows
+        @param table Table to downsample, defaults to the (realm) table
+
+        @throws Error Thrown if error in any database calls
+        @throws Exception Thrown when any other exception is caught
+        '''
+        table = table or self.realm
+        # The merged row keeps the mean quantity and mean price of the source
+        # rows. The standard deviation is pooled from the source rows using
+        # the law of total variance.
+        columns = 'quantity, avg_unit_price, std_dev, high_price, low_price'
+        merged = '''FLOOR(AVG(quantity)), FLOOR(AVG(avg_unit_price)),
+            FLOOR(SQRT(AVG(std_dev::NUMERIC * std_dev) + VAR_POP(avg_unit_price))),
+            MAX(high_price), MIN(low_price)'''
+        self.__downsample(table, 'hour', 'day', hourly_days, columns, merged)
+        self.__downsample(table, 'day', 'week', daily_days, columns, merged)
+
+    def applyDeltaRetention(self, hourly_days, daily_days):
+        '''
+        Downsamples aged rows of the (realm)_deltas table the same way
+        applyRetention does for the (realm) table. The listing counts of the
+        merged rows are summed. checkDeltaTablesExist must be called first.
+
+        @param hourly_days Number of days to keep hourly rows
+        @param daily_days Number of days to keep daily rows
+
+        @throws Error Thrown if error in any database calls
+        @throws Exception Thrown when any other exception is caught
+        '''
+        columns = 'new_listings, disappeared_listings'
+        merged = 'SUM(new_listings), SUM(disappeared_listings)'
+        self.__downsample(self.realm + '_deltas', 'hour', 'day', hourly_days, columns, merged)
+        self.__downsample(self.realm + '_deltas', 'day', 'week', daily_days, columns, merged)
+
+    def __downsample(self, table, src_bucket, dst_bucket, days, columns, merged):
+        '''
+        Merges rows of bucket src_bucket older than the given number of days
+        into rows of bucket dst_bucket. Each destination bucket is compacted
+        and its source rows deleted in its own short transaction, so ingest
+        into the table is never blocked for long and an interrupted run
+        can resume where it left off.
+
+        @param table Table to downsample
+        @param src_bucket Bucket of the rows to merge ('hour' or 'day')
+        @param dst_bucket Bucket of the merged rows ('day' or 'week')
+        @param days Age in days after which src_bucket rows are merged
+        @param columns Comma separated value columns of the table
+        @param merged Comma separated aggregates merging each value column
+
+        @throws Error Thrown if error in any database calls
+        @throws Exception Thrown when any other exception is caught
+        '''
+        try:
+            local_conn = self.getConn()
+            if local_conn:
+                cur = local_conn.cursor()
+                count = 0
+                while True:
+                    cur.execute(sql.SQL(
+                        """
+                        SELECT DATE_TRUNC(%s, MIN(interval))
+                        FROM {}
+                        WHERE bucket = %s AND interval < DATE_TRUNC(%s, NOW() - %s * INTERVAL '1 day')
+                        """).format(sql.Identifier(table)),
+                        (dst_bucket, src_bucket, dst_bucket, int(days))
+                    )
+                    start = cur.fetchone()[0]
+                    if start is None:
+                        break
+                    cur.execute(sql.SQL(
+                        """
+                        INSERT INTO {} (interval, item_id, {}, bucket)
+                            SELECT %s, item_id, {}, %s
+                            FROM {}
+                            WHERE bucket = %s AND interval >= %s AND interval < %s + INTERVAL '1 {}'
+                            GROUP BY item_id ORDER BY item_id;
+                        DELETE FROM {}
+                            WHERE bucket = %s AND interval >= %s AND interval < %s + INTERVAL '1 {}';
+                        """).format(sql.Identifier(table), sql.SQL(columns), sql.SQL(merged), sql.Identifier(table),
+                            sql.SQL(dst_bucket), sql.Identifier(table), sql.SQL(dst_bucket)),
+                        (start, dst_bucket, src_bucket, start, start, src_bucket, start, start)
+                    )
+                    local_conn.commit()
+                    count += 1
+                cur.close()
+                self.putConn(local_conn)
+                logging.debug("Downsampled %d %s buckets of table %s" % (count, dst_bucket, table))
+        except (Exception, psycopg2.Error) as e:
+            logging.exception(str(e))
+            raise e
+
+    def streamHistory(self, since=None, chunk_size=50000):
+        '''
+        Streams the rows of the (realm) table ingested in or after the given
+        interval, ordered by interval. A server-side cursor is used so only chunk_size
+        rows are held in memory at a time. The cursor and its connection are
+        released even if the caller stops iterating early. checkTableExists
+        must be called first.
+
+        @param since Only rows with the same or a later interval are returned.
+                     All rows are returned if None.
+        @param chunk_size Number of rows fetched per round trip
+
+        @return generator of lists of tuples (interval, item_id, quantity,
+                avg_unit_price, std_dev, high_price, low_price, bucket)
+
+        @throws Error Thrown if error in any database calls
+        @throws Exception Thrown when any other exception is caught
+        '''
+        try:
+            local_conn = self.getConn()
+        except (Exception, psycopg2.Error) as e:
+            logging.exception(str(e))
+            raise e
+        try:
+            cur = local_conn.cursor(name=self.realm + '_export')
+            cur.itersize = chunk_size
+            cur.execute(sql.SQL(
+                """
+                SELECT interval, item_id, quantity, avg_unit_price, std_dev, high_price, low_price, bucket
+                FROM {} {}
+                ORDER BY interval, item_id
+                """).format(sql.Identifier(self.realm), sql.SQL('' if since is None else 'WHERE interval >= %s')),
+                [] if since is None else (since,)
+            )
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        except (Exception, psycopg2.Error) as e:
+            logging.exception(str(e))
+            raise e
+        finally:
+            # Also runs if the caller stops iterating early. Ending the read
+            # only transaction closes the server-side cursor.
+            if not local_conn.closed:
+                local_conn.rollback()
+            self.putConn(local_conn)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3.9
+
+from dbConnect import *
+import argparse
+import datetime
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+WATERMARK_FILE = '_watermark'
+
+def readWatermark(realm_dir):
+    '''
+    Reads the interval of the last exported hour of a realm.
+
+    @param realm_dir Export directory of the realm
+
+    @return datetime of the last exported hour
+    @return None returned if nothing has been exported yet
+    '''
+    path = os.path.join(realm_dir, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return datetime.datetime.fromisoformat(f.read().strip())
+
+def writeWatermark(realm_dir, interval):
+    '''
+    Atomically stores the interval of the last exported hour of a realm.
+
+    @param realm_dir Export directory of the realm
+    @param interval datetime of the last exported interval
+    '''
+    path = os.path.join(realm_dir, WATERMARK_FILE)
+    with open(path + '.tmp', 'w') as f:
+        f.write(interval.isoformat())
+    os.replace(path + '.tmp', path)
+
+def exportHistory(dbcon, out_dir, chunk_size=50000):
+    '''
+    Exports the history of the realm selected with dbcon.checkTableExists to
+    Parquet files partitioned by month, out_dir/(realm)/month=YYYY-MM/. Rows are
+    streamed from the database in chunks of chunk_size. The export is
+    incremental: each run exports the rows from the last exported hour onwards
+    and adds them as new part files to each month it touches. The last hour of
+    a run is written to a part file of its own, which the next run overwrites,
+    so rows ingested into that hour after the export are not lost. Rows
+    downsampled by the retention policy keep their old interval and are
+    therefore not exported again.
+
+    @param dbcon postgresql connection wrapper class
+    @param out_dir Root directory of the export
+    @param chunk_size Number of rows read from the database at a time
+
+    @return count Number of rows exported
+
+    @throws ImportError Thrown if pyarrow is not installed
+    @throws Exception Thrown when any other exception is caught
+    '''
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        logging.exception('pyarrow is required to export history')
+        raise e
+
+    schema = pa.schema([
+        ('interval', pa.timestamp('us')),
+        ('item_id', pa.int32()),
+        ('quantity', pa.int32()),
+        ('avg_unit_price', pa.int64()),
+        ('std_dev', pa.int64()),
+        ('high_price', pa.int64()),
+        ('low_price', pa.int64()),
+        ('bucket', pa.string())
+    ])
+    realm_dir = os.path.join(out_dir, dbcon.realm)
+    os.makedirs(realm_dir, exist_ok=True)
+    since = readWatermark(realm_dir)
+
+    def partPath(interval):
+        month_dir = os.path.join(realm_dir, 'month=' + interval.strftime('%Y-%m'))
+        os.makedirs(month_dir, exist_ok=True)
+        return os.path.join(month_dir, 'part-%s.parquet' % interval.strftime('%Y%m%d%H'))
+
+    def toTable(rows):
+        return pa.Table.from_arrays(
+            [pa.array(column, type=field.type) for column, field in zip(zip(*rows), schema)], schema=schema)
+
+    def writeHour(rows):
+        # Replaces the part file of a single hour atomically
+        path = partPath(rows[0][0])
+        pq.write_table(toTable(rows), path + '.tmp', compression='zstd')
+        os.replace(path + '.tmp', path)
+
+    month = None
+    writer = None
+    def writeRows(rows):
+        nonlocal month, writer
+        row_month = rows[0][0].strftime('%Y-%m')
+        if row_month != month:
+            if writer:
+                writer.close()
+            month = row_month
+            writer = pq.ParquetWriter(partPath(rows[0][0]), schema, compression='zstd')
+        writer.write_table(toTable(rows))
+
+    hour = None
+    held = list()
+    count = 0
+    try:
+        for rows in dbcon.streamHistory(since, chunk_size):
+            # Rows are ordered by interval, one hour is held until it is complete
+            for row in rows:
+                if row[0] != hour:
+                    if held:
+                        # The last hour of the previous run is rewritten in place
+                        (writeHour if hour == since else writeRows)(held)
+                    hour = row[0]
+                    held = list()
+                held.append(row)
+            count += len(rows)
+        if held:
+            writeHour(held)
+    finally:
+        if writer:
+            writer.close()
+    if hour:
+        writeWatermark(realm_dir, hour)
+    logging.info('Exported %d rows of %s to %s' % (count, dbcon.realm, realm_dir))
+    return count
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export realm history to Parquet files partitioned by month.')
+    parser.add_argument('--out', default='export', help='root directory of the export')
+    parser.add_argument('--chunk-size', type=int, default=50000, help='rows read from the database at a time')
+    args = parser.parse_args(argv)
+
+    db_params = config('settings.ini', 'wowdb')
+    dbcon = dbConnect()
+    dbcon.connect(**db_params)
+    # Realms are read from the database, so exporting needs no API access
+    for realm in dbcon.getRealms():
+        dbcon.checkTableExists(realm)
+        exportHistory(dbcon, args.out, args.chunk_size)
+
+if __name__ == "__main__":
+    main()
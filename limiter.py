@@ -0,0 +1,111 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+def isThrottled(e):
+    '''
+    Checks if an exception was caused by a 429 Too Many Requests response of
+    python-wowapi or urllib.
+
+    @param e Exception to check
+
+    @return true/false
+    '''
+    msg = str(e)
+    return msg.endswith(' 429') or 'Error 429' in msg
+
+class AdaptiveLimiter():
+    '''
+    Limits the number of concurrent API requests. The limit grows by one
+    request per round of successful requests faster than latency_target and is
+    halved whenever the API answers 429 Too Many Requests (additive increase,
+    multiplicative decrease).
+    '''
+    def __init__(self, initial=10, minimum=1, maximum=100, latency_target=2.0):
+        '''
+        Constructor, initializes the limit.
+
+        @param initial Initial number of concurrent requests
+        @param minimum, maximum Bounds of the number of concurrent requests
+        @param latency_target Requests slower than this (seconds) do not grow
+                              the limit
+        '''
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.latency_target = latency_target
+        self.cond = threading.Condition()
+        self.active = 0
+        self.requests = 0
+        self.throttles = 0
+        self.latency_total = 0.0
+
+    def acquire(self):
+        '''
+        Waits until a request may start.
+        '''
+        with self.cond:
+            while self.active >= int(self.limit):
+                self.cond.wait()
+            self.active += 1
+
+    def release(self, latency, throttled=False):
+        '''
+        Ends a request started with acquire and adapts the limit.
+
+        @param latency Duration of the request in seconds
+        @param throttled True if the API answered 429
+        '''
+        with self.cond:
+            self.active -= 1
+            self.requests += 1
+            self.latency_total += latency
+            if throttled:
+                self.throttles += 1
+                self.limit = max(self.minimum, self.limit / 2)
+            elif latency < self.latency_target:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+    def call(self, func, *args, retries=3):
+        '''
+        Calls func within the limit, retrying with exponential backoff while
+        the API answers 429.
+
+        @param func Function sending the request
+        @param args Arguments of func
+        @param retries Number of retries after a 429
+
+        @return result of func
+
+        @throws Exception Thrown when func raises anything else than a 429 or
+                          keeps raising 429 after all retries
+        '''
+        for attempt in range(retries + 1):
+            self.acquire()
+            start_time = time.perf_counter()
+            try:
+                res = func(*args)
+            except Exception as e:
+                throttled = isThrottled(e)
+                self.release(time.perf_counter() - start_time, throttled)
+                if not throttled or attempt == retries:
+                    raise e
+                time.sleep(2 ** attempt)
+            else:
+                self.release(time.perf_counter() - start_time)
+                return res
+
+    def stats(self):
+        '''
+        Gets the request statistics.
+
+        @return Dictionary with limit, requests, throttles and avg_latency
+                (seconds)
+        '''
+        with self.cond:
+            return {'limit': int(self.limit), 'requests': self.requests, 'throttles': self.throttles,
+                'avg_latency': self.latency_total / self.requests if self.requests else 0.0}
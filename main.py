@@ -1,24 +1,26 @@
 #!/usr/bin/env python3.9
 
-from wowDB import *
-from dbConnect import *
+from aggregate import findPrice
+from limiter import AdaptiveLimiter
 from notification import notify
-import pprint as pprint
+import argparse
+import subprocess
+import sys
 import time
 import logging
-import schedule
 
 import concurrent.futures as concurrent
 
 wow = None
 
-def reqItemDet(wow, dbcon, item_id):
+def reqItemDet(wow, dbcon, item_id, limiter):
     '''
     Looks for Item name and picture if it does not already exist in the database
 
     @param wow Wowapi wrapper object
     @param dbcon postgresql connection wrapper class
     @param item_id ID of item used to download name and picture
+    @param limiter AdaptiveLimiter of the API requests
 
     @return item_id id of an invalid item
     @return None nothing returned if item is valid
@@ -27,8 +29,8 @@ def reqItemDet(wow, dbcon, item_id):
     '''
     try:
         if not dbcon.checkItemExists(item_id):
-            item_name = wow.findItemName(item_id)
-            item_pic = wow.findItemPic(item_id)
+            item_name = limiter.call(wow.findItemName, item_id)
+            item_pic = limiter.call(wow.findItemPic, item_id)
             dbcon.storeItemDetails(item_id, item_name, item_pic)
     except Exception as e:
         logging.warning('Item name or picture not found for ID %d' % item_id)
@@ -36,13 +38,16 @@ def reqItemDet(wow, dbcon, item_id):
     else:
         return None
 
-def filterInvalidListings(wow, dbcon, ids):
+def filterInvalidListings(wow, dbcon, ids, limiter):
     '''
-    Creates a thread pool whose threads download item information.
+    Creates a thread pool whose threads download item information. The pool
+    has no more threads than pending items, and the limiter decides how many
+    of them send requests at once.
 
     @param wow Wowapi wrapper object
     @param dbcon postgresql connection wrapper class
     @param ids list of ids to check
+    @param limiter AdaptiveLimiter of the API requests
 
     @return result_futures A list of futures
     @return None returned if invalid item
@@ -50,9 +55,11 @@ def filterInvalidListings(wow, dbcon, ids):
     @throws WowApiException handled if item is invalid
     @throws Exception Thrown when any other exception is caught
     '''
-    with concurrent.ThreadPoolExecutor(max_workers=100) as executor:
+    from wowapi.exceptions import WowApiException
+
+    with concurrent.ThreadPoolExecutor(max_workers=max(1, min(limiter.maximum, len(ids)))) as executor:
         try:
-            result_futures = list(map(lambda x: executor.submit(reqItemDet, wow, dbcon, x), ids))
+            result_futures = list(map(lambda x: executor.submit(reqItemDet, wow, dbcon, x, limiter), ids))
             return result_futures
         except WowApiException as e:
             logging.warning(str(e))
@@ -61,69 +68,342 @@ def filterInvalidListings(wow, dbcon, ids):
             logging.exception(str(e))
             raise e
 
-def findPrice(listing):
+def setupLogging():
+    logging.basicConfig(filename='info.log', format='%(asctime)s - %(levelname)'
+        's: %(message)s', level=logging.DEBUG, datefmt='%Y-%m-%d %H:%M:%S')
+
+def createLimiter(options):
     '''
-    Finds the unit price of the listing.
+    Creates the limiter of the API requests from the options section of
+    settings.ini.
 
-    @param listing Listing of an item
-    
-    @return unit_price of item
-    @return None returned if listing does not contain valid price
+    @param options Dictionary of the options section of settings.ini
+
+    @return AdaptiveLimiter
     '''
-    if 'unit_price' in listing:
-        return listing['unit_price']
-    elif 'buyout' in listing:
-        return listing['buyout']/listing['quantity']
-    return
+    return AdaptiveLimiter(int(options.get('api_initial_workers', '10')), 1, int(options.get('api_max_workers', '100')))
 
-def job():
-    logging.basicConfig(filename='info.log', format='%(asctime)s - %(levelname)'
-        's: %(message)s', level=logging.DEBUG, datefmt='%Y-%m-%d %H:%M:%S')
+def ingestRealm(wow, dbcon, options, limiter):
+    '''
+    Downloads the auction house of a realm and adds the analyzed snapshot to
+    the database. By default the download, the snapshot load and the item
+    detail downloads run as a pipeline. With more than one process the
+    streamed listings are analyzed by a process pool instead.
+
+    @param wow Wowapi wrapper object of the realm
+    @param dbcon postgresql connection wrapper class
+    @param options Dictionary of the options section of settings.ini
+    @param limiter AdaptiveLimiter of the API requests
+    '''
+    # Keep auction IDs only when listing deltas are tracked
+    track_deltas = options.get('track_deltas', 'false').lower() == 'true'
+    processes = int(options.get('processes', '1'))
+
+    dbcon.checkTableExists(wow.realm_slug)
+    if track_deltas:
+        dbcon.checkDeltaTablesExist()
+    if processes > 1:
+        from aggregate import aggregateListings
+
+        # Item details are downloaded while the stream is aggregated in worker
+        # processes, and the rows of invalid items are dropped before loading
+        with concurrent.ThreadPoolExecutor(max_workers=limiter.maximum) as executor:
+            futures = list()
+            def resolve(ids):
+                futures.extend(executor.submit(reqItemDet, wow, dbcon, item_id, limiter) for item_id in dbcon.getIDDiff(ids))
+            def validRows(batches):
+                invalid_ids = None
+                for rows in batches:
+                    if invalid_ids is None:
+                        # Every item ID is submitted before the first shard completes
+                        invalid_ids = {future.result() for future in concurrent.as_completed(futures) if future.result()}
+                    yield [row for row in rows if row[0] not in invalid_ids]
+            formatted_list = aggregateListings(wow.streamAuctions(), (), processes,
+                lambda batches: dbcon.storeAggregates(validRows(batches)), track_deltas, resolve=resolve)
+        if track_deltas:
+            dbcon.loadSnapshot([formatted_list], ['item_id', 'quantity', 'price', 'auction_id'])
+            dbcon.insertListingDeltas()
+        else:
+            # The snapshot is not used, clear it rather than keep a stale hour
+            dbcon.clearSnapshot()
+        logging.info('Aggregated the listings of %s with %d processes', wow.realm_slug, processes)
+    else:
+        from pipeline import runPipeline
+
+        columns = ['item_id', 'quantity', 'price'] + (['auction_id'] if track_deltas else [])
+        def parse(x):
+            price = findPrice(x)
+            if price is None:
+                return None
+            if track_deltas:
+                return x['item']['id'], (x['item']['id'], x['quantity'], price, x['id'])
+            return x['item']['id'], (x['item']['id'], x['quantity'], price)
+
+        # Item details are downloaded while the snapshot loads, invalid items
+        # are left out by insertNewListings
+        with concurrent.ThreadPoolExecutor(max_workers=limiter.maximum) as executor:
+            def resolve(ids):
+                for item_id in dbcon.getIDDiff(ids):
+                    executor.submit(reqItemDet, wow, dbcon, item_id, limiter)
+            count = runPipeline(wow.streamAuctions(), parse, lambda batches: dbcon.loadSnapshot(batches, columns), resolve)
+
+        # Add analyzed data to database
+        dbcon.insertNewListings()
+        if track_deltas:
+            dbcon.insertListingDeltas()
+        logging.info('Snapshot length of %s: %d', wow.realm_slug, count)
+
+def ingestCommodities(wow, dbcon, limiter):
+    '''
+    Streams the region-wide commodity auction house into the database. The
+    listings are loaded in batches as they are parsed, so memory use stays
+    bounded. Item details are then downloaded for new items and items whose
+    details cannot be found are left out when the snapshot is analyzed.
+
+    @param wow Wowapi wrapper object of any realm in the region
+    @param dbcon postgresql connection wrapper class
+    @param limiter AdaptiveLimiter of the API requests
+    '''
+    dbcon.checkCommodityTablesExist(wow.region)
+    ids = dbcon.storeCommodities(wow.streamCommodities())
+    if ids:
+        check_list = dbcon.getIDDiff(sorted(ids))
+        results = filterInvalidListings(wow, dbcon, check_list, limiter)
+        concurrent.wait(results)
+    dbcon.insertCommodityListings()
+    logging.info('Commodity items of %s: %d', wow.region, len(ids))
+
+def job(backend='auto'):
+    '''
+    Downloads the auction house of every configured realm, and the commodity
+    auction house of the region once if enabled, and adds the analyzed
+    snapshots to the database.
+
+    @param backend Notification backend used to report errors
+    '''
+    from wowDB import loadRealms
+    from dbConnect import config, dbConnect
+
+    setupLogging()
     start_time = time.time()
     try:
+        # A failing realm is reported but does not stop the others
+        errors = list()
         bnetcred = config('settings.ini', 'bnetcred')
-        wow = WowDB(**bnetcred)
+        realms = loadRealms(bnetcred, errors)
 
         db_params = config('settings.ini', 'wowdb')
         dbcon = dbConnect()
         dbcon.connect(**db_params)
-        
-        data = wow.findAuctions()
-        data = sorted(data, key = lambda i: i['item']['id'])
-        
-        # Get list of unique IDs
-        ids = list()
-        [ids.append(x['item']['id']) for x in data if x['item']['id'] not in ids]
-
-        # Get list of ids that do not already exist in item_list table
-        check_list = dbcon.getIDDiff(ids)
-
-        # Remove listings with invalid item IDs
-        results = filterInvalidListings(wow, dbcon, check_list)
-        invalid_ids = [future.result() for future in concurrent.as_completed(results) if future.result()]
-        filtered_list = [listing for listing in data if listing['item']['id'] not in invalid_ids]
-
-        formatted_list = list()
-        [formatted_list.append({'item_id': x['item']['id'], 'price': findPrice(x), 'quantity': x['quantity']}) for x in filtered_list if ('unit_price' in x or 'buyout' in x)]
-        dbcon.checkTableExists(wow.realm_slug)
-        dbcon.clearSnapshot()
-        dbcon.storeSnapshot(formatted_list)
 
-        # Add analyzed data to database
-        dbcon.insertNewListings()
-        logging.info('Filtered list length: %d', len(formatted_list))
+        options = config('settings.ini', 'options', required=False)
+        limiter = createLimiter(options)
+        for wow in realms:
+            try:
+                ingestRealm(wow, dbcon, options, limiter)
+            except Exception as e:
+                errors.append((wow.realm, e))
+        if realms and options.get('commodities', 'false').lower() == 'true':
+            try:
+                ingestCommodities(realms[0], dbcon, limiter)
+            except Exception as e:
+                errors.append(('commodities', e))
+        logging.info('Connection pool: %s', dbcon.poolStats())
+        logging.info('API requests: %s', limiter.stats())
+        if errors:
+            raise Exception('\n'.join('%s: %s' % (name, str(e)) for name, e in errors))
     except Exception as e:
         # print(str(e))
-        notify(str(e))
+        notify(str(e), backend)
         logging.error(str(e) + '\n')
     else:
         logging.info('Execution time %s seconds\n' % (time.time() - start_time))
 
-def main():
-    schedule.every().hour.do(job).at(':00')
+def maintenance(backend='auto'):
+    '''
+    Applies the retention policy in settings.ini to the history tables,
+    downsampling aged hourly rows into daily rows and aged daily rows into
+    weekly rows. The realms are read from the database, so maintenance needs
+    no Battle.net API access.
+
+    @param backend Notification backend used to report errors
+    '''
+    from dbConnect import config, dbConnect
+
+    setupLogging()
+    start_time = time.time()
+    try:
+        # A failing realm is reported but does not stop the others
+        errors = list()
+        db_params = config('settings.ini', 'wowdb')
+        dbcon = dbConnect()
+        dbcon.connect(**db_params)
+
+        retention = config('settings.ini', 'retention', required=False)
+        hourly_days = int(retention.get('hourly_days', '30'))
+        daily_days = int(retention.get('daily_days', '365'))
+        options = config('settings.ini', 'options', required=False)
+        track_deltas = options.get('track_deltas', 'false').lower() == 'true'
+        for realm in dbcon.getRealms():
+            try:
+                dbcon.checkTableExists(realm)
+                dbcon.applyRetention(hourly_days, daily_days)
+                if track_deltas:
+                    dbcon.checkDeltaTablesExist()
+                    dbcon.applyDeltaRetention(hourly_days, daily_days)
+            except Exception as e:
+                errors.append((realm, e))
+        if options.get('commodities', 'false').lower() == 'true':
+            try:
+                dbcon.checkCommodityTablesExist(config('settings.ini', 'bnetcred')['region'])
+                dbcon.applyRetention(hourly_days, daily_days, dbcon.commodities)
+            except Exception as e:
+                errors.append(('commodities', e))
+        if errors:
+            raise Exception('\n'.join('%s: %s' % (name, str(e)) for name, e in errors))
+    except Exception as e:
+        notify(str(e), backend)
+        logging.error(str(e) + '\n')
+    else:
+        logging.info('Maintenance time %s seconds\n' % (time.time() - start_time))
+
+def backfill(backend='auto'):
+    '''
+    Downloads the item name and picture of every item in the realm history that
+    is missing from table item_list.
+
+    @param backend Notification backend used to report errors
+    '''
+    from wowDB import loadRealms
+    from dbConnect import config, dbConnect
+
+    setupLogging()
+    start_time = time.time()
+    try:
+        bnetcred = config('settings.ini', 'bnetcred')
+        realms = loadRealms(bnetcred)
+
+        db_params = config('settings.ini', 'wowdb')
+        dbcon = dbConnect()
+        dbcon.connect(**db_params)
+
+        limiter = createLimiter(config('settings.ini', 'options', required=False))
+        for wow in realms:
+            dbcon.checkTableExists(wow.realm_slug)
+            check_list = dbcon.getMissingItemIDs()
+            results = filterInvalidListings(wow, dbcon, check_list, limiter)
+            invalid_ids = [future.result() for future in concurrent.as_completed(results) if future.result()]
+            logging.info('Backfilled %d items of %s, %d invalid', len(check_list) - len(invalid_ids), wow.realm_slug, len(invalid_ids))
+    except Exception as e:
+        notify(str(e), backend)
+        logging.error(str(e) + '\n')
+    else:
+        logging.info('Backfill time %s seconds\n' % (time.time() - start_time))
+
+def bench(modules, repeat=5, listings=0, processes=(1,)):
+    '''
+    Measures the cold import time of each module in a fresh interpreter and
+    prints the best of repeat runs. Importing main only pulls in the standard
+    library, the heavy dependencies are imported by the subcommands that need
+    them. Also measures the throughput of the multiprocessing aggregation if
+    listings is set.
+
+    @param modules List of module names to import
+    @param repeat Number of runs per module
+    @param listings Number of synthetic listings to aggregate
+    @param processes Numbers of worker processes to aggregate with
+    '''
+    for module in modules:
+        best = None
+        for i in range(repeat):
+            start_time = time.perf_counter()
+            res = subprocess.run([sys.executable, '-c', 'import ' + module], capture_output=True)
+            elapsed = time.perf_counter() - start_time
+            if res.returncode != 0:
+                best = None
+                break
+            best = elapsed if best is None else min(best, elapsed)
+        if best is None:
+            print('%-16s failed to import' % module)
+        else:
+            print('%-16s %8.1f ms' % (module, best * 1000))
+    if listings:
+        from aggregate import benchAggregate
+        for count in processes:
+            elapsed, rate = benchAggregate(listings, count)
+            print('aggregate %d listings with %d processes: %.2f s, %.0f listings/s' % (listings, count, elapsed, rate))
+
+def compare(item_id=None, limit=20):
+    '''
+    Prints the price of an item on every tracked realm, or the items with the
+    largest price spread between realms if no item is given.
+
+    @param item_id ID of the item to compare
+    @param limit Number of items with the largest spread to print
+    '''
+    from dbConnect import config, dbConnect
+    from realmQuery import RealmQuery
+
+    db_params = config('settings.ini', 'wowdb')
+    dbcon = dbConnect()
+    dbcon.connect(**db_params)
+    query = RealmQuery(dbcon)
+    if item_id is None:
+        for row in query.largestSpreads(limit):
+            print('%-10d spread %-12d %s %d -> %s %d' % row)
+    else:
+        for row in query.compareItem(item_id):
+            print('%-24s avg %-12d low %-12d high %-12d quantity %d' % row)
+
+def daemon(backend='auto'):
+    '''
+    Runs job every hour and maintenance every day.
+
+    @param backend Notification backend used to report errors
+    '''
+    import schedule
+
+    schedule.every().hour.do(job, backend).at(':00')
+    schedule.every().day.at('00:30').do(maintenance, backend)
     while True:
         schedule.run_pending()
         time.sleep(60)
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fills the wowdb database with World of Warcraft auction house data.')
+    parser.add_argument('--headless', action='store_true', help='never open a dialog box, only log errors')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('daemon', help='run every hour (default)')
+    subparsers.add_parser('run-once', help='ingest the auction house once')
+    subparsers.add_parser('maintenance', help='apply the retention policy once')
+    subparsers.add_parser('backfill', help='download missing item names and pictures')
+    bench_parser = subparsers.add_parser('bench', help='measure cold import time')
+    bench_parser.add_argument('--repeat', type=int, default=5)
+    bench_parser.add_argument('--listings', type=int, default=0, help='also benchmark aggregating this many listings')
+    bench_parser.add_argument('--processes', type=int, nargs='+', default=[1], help='worker processes to benchmark')
+    compare_parser = subparsers.add_parser('compare', help='compare prices across realms')
+    compare_parser.add_argument('item_id', type=int, nargs='?', help='item to compare, largest spreads if omitted')
+    compare_parser.add_argument('--limit', type=int, default=20)
+    export_parser = subparsers.add_parser('export', help='export history to Parquet')
+    export_parser.add_argument('args', nargs=argparse.REMAINDER, help='arguments passed to export.py')
+    args = parser.parse_args(argv)
+
+    backend = 'log' if args.headless else 'auto'
+    if args.command == 'run-once':
+        job(backend)
+    elif args.command == 'maintenance':
+        maintenance(backend)
+    elif args.command == 'backfill':
+        backfill(backend)
+    elif args.command == 'bench':
+        bench(['main', 'notification', 'dbConnect', 'wowDB', 'PySimpleGUI'], args.repeat, args.listings, args.processes)
+    elif args.command == 'compare':
+        compare(args.item_id, args.limit)
+    elif args.command == 'export':
+        import export
+        export.main(args.args)
+    else:
+        daemon(backend)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,6 +1,56 @@
-import PySimpleGUI as sg
+import logging
+import os
+import subprocess
+import sys
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+def hasDisplay():
+    '''
+    Checks if a dialog box can be shown. On Windows, services and tasks run
+    without a logged on user live in session 0, where nobody can see or close
+    a dialog box.
+
+    @return true/false
+    '''
+    if os.name == 'nt':
+        import ctypes
+        session = ctypes.c_ulong()
+        if ctypes.windll.kernel32.ProcessIdToSessionId(os.getpid(), ctypes.byref(session)):
+            return session.value != 0
+        return True
+    return sys.platform == 'darwin' or bool(os.environ.get('DISPLAY'))
+
+def notify(errmsg, backend='auto'):
+    '''
+    Reports an error without blocking the caller. Backend 'gui' shows the error
+    in a dialog box opened by a separate process, backend 'log' only writes the
+    error to the log and stderr. Backend 'auto' picks 'gui' if a display is
+    available and 'log' otherwise.
+
+    @param errmsg Error message to report
+    @param backend 'auto', 'gui' or 'log'
+    '''
+    if backend == 'auto':
+        backend = 'gui' if hasDisplay() else 'log'
+    if backend == 'gui':
+        try:
+            subprocess.Popen([sys.executable, os.path.abspath(__file__), errmsg])
+            return
+        except Exception as e:
+            logging.warning('Could not open dialog box: %s' % str(e))
+    logging.critical(errmsg)
+    print(errmsg, file=sys.stderr)
+
+def showDialog(errmsg):
+    '''
+    Shows the error in a dialog box and blocks until it is closed.
+
+    @param errmsg Error message to show
+    '''
+    import PySimpleGUI as sg
 
-def notify(errmsg):
     layout = [[sg.Text(errmsg)], [sg.Button("OK")]]
 
     window = sg.Window("Demo", layout)
@@ -10,4 +60,7 @@ def notify(errmsg):
         if event == "OK" or event == sg.WIN_CLOSED:
             break
 
-    window.close()
\ No newline at end of file
+    window.close()
+
+if __name__ == "__main__":
+    showDialog(sys.argv[1])
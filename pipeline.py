@@ -0,0 +1,128 @@
+import logging
+import queue as queue
+import threading
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+class Stage(threading.Thread):
+    '''
+    Thread consuming the items put in a bounded queue. The consumer is called
+    once with an iterator over the items. If the producer fails, the exception
+    is raised from the iterator so the consumer can abort without committing.
+    '''
+    def __init__(self, consumer, maxsize):
+        '''
+        Constructor, creates the bounded queue of the stage.
+
+        @param consumer Callable consuming an iterable of items
+        @param maxsize Maximum number of items waiting in the queue
+        '''
+        threading.Thread.__init__(self, daemon=True)
+        self.consumer = consumer
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.error = None
+        self.result = None
+
+    def __items(self):
+        for item in iter(self.queue.get, None):
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def run(self):
+        try:
+            self.result = self.consumer(self.__items())
+        except Exception as e:
+            self.error = e
+            # Keep draining so the producer never blocks on a full queue
+            for item in iter(self.queue.get, None):
+                pass
+
+    def put(self, item):
+        '''
+        Puts an item in the queue, blocking while the queue is full.
+
+        @param item Item to put
+        '''
+        self.queue.put(item)
+
+    def finish(self, error=None):
+        '''
+        Signals the end of the items and waits for the consumer to return. The
+        result and exception of the consumer are stored in result and error.
+
+        @param error Exception raised to the consumer instead of ending normally
+        '''
+        if error:
+            self.queue.put(error)
+        self.queue.put(None)
+        self.join()
+
+def runPipeline(listings, parse, load, resolve, batch_size=5000, queue_size=8):
+    '''
+    Parses auction listings while loading them into the database and resolving
+    item details concurrently. Parsed rows are sent to load in batches of
+    batch_size through a bounded queue, and every item ID seen for the first
+    time is sent to resolve through a second bounded queue. Since listings is
+    usually a stream of the download, downloading, parsing, loading and item
+    resolution all overlap and the run takes about as long as its slowest
+    stage.
+
+    @param listings Iterable of auction listings
+    @param parse Callable returning a tuple (item_id, row) for a listing, or
+                 None to skip it
+    @param load Callable consuming an iterable of lists of rows
+    @param resolve Callable called with each list of new item IDs
+    @param batch_size Number of rows per batch
+    @param queue_size Maximum number of batches waiting in each queue
+
+    @return result of load
+
+    @throws Exception Thrown when any exception is caught in a stage
+    '''
+    def resolveAll(id_batches):
+        for ids in id_batches:
+            resolve(ids)
+
+    loader = Stage(load, queue_size)
+    resolver = Stage(resolveAll, queue_size)
+    loader.start()
+    resolver.start()
+    seen = set()
+    rows = list()
+    new_ids = list()
+    error = None
+    try:
+        for x in listings:
+            parsed = parse(x)
+            if parsed is None:
+                continue
+            item_id, row = parsed
+            rows.append(row)
+            if item_id not in seen:
+                seen.add(item_id)
+                new_ids.append(item_id)
+            if len(rows) >= batch_size:
+                if loader.error or resolver.error:
+                    break
+                loader.put(rows)
+                rows = list()
+                if new_ids:
+                    resolver.put(new_ids)
+                    new_ids = list()
+        else:
+            if rows:
+                loader.put(rows)
+            if new_ids:
+                resolver.put(new_ids)
+    except Exception as e:
+        logging.exception(str(e))
+        error = e
+    loader.finish(error)
+    resolver.finish(error)
+    error = error or loader.error or resolver.error
+    if error:
+        raise error
+    logging.debug('Pipelined %d items' % len(seen))
+    return loader.result
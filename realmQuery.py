@@ -0,0 +1,168 @@
+import psycopg2
+from psycopg2 import sql
+import datetime
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+class RealmQuery():
+    '''
+    Class to compare prices across all tracked realms. The (realm)_latest
+    tables are treated as one dataset, using table realm_index to find the
+    realms and their latest ingested hour. Only realms whose latest hour is at
+    most one hour older than the most recent ingested hour are compared. Realms
+    are ingested one after another, so while an hourly run is in progress the
+    realms it has not reached yet are still compared on the previous hour,
+    while a realm that stopped ingesting drops out. Results are cached until a
+    realm ingests a new hour.
+    '''
+    tolerance = datetime.timedelta(hours=1)
+
+    def __init__(self, dbcon):
+        '''
+        Constructor, stores the connection and creates the cache.
+
+        @param dbcon postgresql connection wrapper class
+        '''
+        self.dbcon = dbcon
+        self.cache = dict()
+        self.cache_lock = threading.Lock()
+
+    def realms(self):
+        '''
+        Gets the tracked realms and their latest ingested hour.
+
+        @return List of tuples (realm, latest_interval) ordered by realm
+
+        @throws Error Thrown if error in any database calls
+        @throws Exception Thrown when any other exception is caught
+        '''
+        return self.__fetch(sql.SQL("SELECT realm, latest_interval FROM realm_index ORDER BY realm"), [])
+
+    def compareItem(self, item_id):
+        '''
+        Gets the latest stats of an item on every current realm it is listed on
+        this hour. Each realm is a primary key lookup in its (realm)_latest table.
+
+        @param item_id ID of the item
+
+        @return List of tuples (realm, avg_unit_price, low_price, high_price,
+                quantity) ordered from cheapest to most expensive
+
+        @throws Error Thrown if error in any database calls
+        @throws Exception Thrown when any other exception is caught
+        '''
+        def query(realms):
+            selects = [sql.SQL(
+                "SELECT {}::TEXT AS realm, avg_unit_price, low_price, high_price, quantity FROM {} WHERE item_id = %s AND interval = %s"
+                ).format(sql.Literal(realm), sql.Identifier(realm + '_latest')) for realm, interval in realms]
+            params = [p for realm, interval in realms for p in (item_id, interval)]
+            return self.__fetch(sql.SQL(" UNION ALL ").join(selects) + sql.SQL(" ORDER BY avg_unit_price, realm"), params)
+        return self.__cached(('compareItem', item_id), query)
+
+    def cheapestRealm(self, item_id):
+        '''
+        Finds the realm with the lowest average price of an item this hour.
+
+        @param item_id ID of the item
+
+        @return tuple (realm, avg_unit_price, low_price, high_price, quantity)
+        @return None returned if the item is not listed on any realm
+        '''
+        res = self.compareItem(item_id)
+        return res[0] if res else None
+
+    def mostExpensiveRealm(self, item_id):
+        '''
+        Finds the realm with the highest average price of an item this hour.
+
+        @param item_id ID of the item
+
+        @return tuple (realm, avg_unit_price, low_price, high_price, quantity)
+        @return None returned if the item is not listed on any realm
+        '''
+        res = self.compareItem(item_id)
+        return res[-1] if res else None
+
+    def largestSpreads(self, limit=20):
+        '''
+        Finds the items whose average price differs the most between realms
+        this hour.
+
+        @param limit Number of items to return
+
+        @return List of tuples (item_id, spread, cheapest_realm, low_avg_price,
+                most_expensive_realm, high_avg_price) ordered by spread
+
+        @throws Error Thrown if error in any database calls
+        @throws Exception Thrown when any other exception is caught
+        '''
+        def query(realms):
+            selects = [sql.SQL(
+                "SELECT {}::TEXT AS realm, item_id, avg_unit_price FROM {} WHERE interval = %s"
+                ).format(sql.Literal(realm), sql.Identifier(realm + '_latest')) for realm, interval in realms]
+            params = [interval for realm, interval in realms] + [limit]
+            return self.__fetch(sql.SQL(
+                """
+                SELECT item_id, MAX(avg_unit_price) - MIN(avg_unit_price) AS spread,
+                    (ARRAY_AGG(realm ORDER BY avg_unit_price ASC))[1], MIN(avg_unit_price),
+                    (ARRAY_AGG(realm ORDER BY avg_unit_price DESC))[1], MAX(avg_unit_price)
+                FROM ({}) cur
+                GROUP BY item_id HAVING COUNT(*) > 1
+                ORDER BY spread DESC, item_id LIMIT %s
+                """).format(sql.SQL(" UNION ALL ").join(selects)), params)
+        return self.__cached(('largestSpreads', limit), query)
+
+    def __cached(self, key, query):
+        '''
+        Returns the cached result of a query if no realm ingested a new hour
+        since it was cached, otherwise runs and caches the query.
+
+        @param key Key of the query in the cache
+        @param query Function called with the realms of realms() that ingested
+                     the most recent hour or the hour before, to run the query
+
+        @return result of the query
+        '''
+        realms = self.realms()
+        if not realms:
+            return list()
+        version = tuple(realms)
+        with self.cache_lock:
+            cached = self.cache.get(key)
+            if cached and cached[0] == version:
+                return cached[1]
+        oldest = max(interval for realm, interval in realms) - RealmQuery.tolerance
+        res = query([(realm, interval) for realm, interval in realms if interval >= oldest])
+        with self.cache_lock:
+            # Drop the results of previous hours
+            self.cache = {k: v for k, v in self.cache.items() if v[0] == version}
+            self.cache[key] = (version, res)
+        return res
+
+    def __fetch(self, query, params):
+        '''
+        Runs a query and fetches all rows.
+
+        @param query Composed SQL query
+        @param params Parameters of the query
+
+        @return List of tuples
+
+        @throws Error Thrown if error in any database calls
+        @throws Exception Thrown when any other exception is caught
+        '''
+        try:
+            local_conn = self.dbcon.getConn()
+            cur = local_conn.cursor()
+            cur.execute(query, params)
+            res = cur.fetchall()
+            local_conn.commit()
+            cur.close()
+            self.dbcon.putConn(local_conn)
+            return res
+        except (Exception, psycopg2.Error) as e:
+            logging.exception(str(e))
+            raise e
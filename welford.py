@@ -52,6 +52,18 @@ class Welford(object):
         for x in lst:
             self.update(x)
     
+    def merge(self,other):
+        """ Merges the values seen by another Welford into this one using
+        the parallel algorithm of Chan et al. Returns self. """
+        if other.k == 0:
+            return self
+        k = self.k + other.k
+        delta = other.M - self.M
+        self.M = self.M + delta*other.k/k
+        self.S = self.S + other.S + delta*delta*self.k*other.k/k
+        self.k = k
+        return self
+
     def __call__(self,x):
         if hasattr(x,"__iter__"):
             self.consume(x)
@@ -69,5 +81,10 @@ class Welford(object):
         if self.k==1:
             return 0
         return math.sqrt(self.S/(self.k-1))
+    @property
+    def std_pop(self):
+        if self.k==0:
+            return 0
+        return math.sqrt(self.S/self.k)
     def __repr__(self):
         return "<Welford: {} +- {}>".format(self.mean, self.std)
\ No newline at end of file
@@ -1 +1 @@
-C:/Python39/python.exe D:/Users/Chris/Documents/wowDB/main.py
\ No newline at end of file
+C:/Python39/python.exe D:/Users/Chris/Documents/wowDB/main.py --headless
\ No newline at end of file
@@ -1,6 +1,7 @@
 from wowapi import WowApi
 from wowapi.exceptions import *
 import copy
+from datetime import datetime, timedelta
 import math
 from multiprocessing import Event, Manager, Pool, Process, Queue
 import queue as queue
@@ -12,6 +13,29 @@ import logging
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+def loadRealms(bnetcred, errors=None):
+    '''
+    Creates a WowDB for every realm of the comma separated realm setting. All
+    realms share the locale, region and client credentials.
+
+    @param bnetcred Dictionary of the bnetcred section of settings.ini
+    @param errors If a list is given, realms that fail are skipped and
+                  (realm, exception) is appended to it
+
+    @return list of WowDB
+
+    @throws Exception Thrown if a realm fails and errors is None
+    '''
+    realms = list()
+    for realm in bnetcred['realm'].split(','):
+        try:
+            realms.append(WowDB(**dict(bnetcred, realm=realm.strip())))
+        except Exception as e:
+            if errors is None:
+                raise e
+            errors.append((realm.strip(), e))
+    return realms
+
 class WowDB:
     '''
     Class WowDB contains server data and client credentials for the
@@ -183,6 +207,84 @@ class WowDB:
             logging.exception(str(e))
             raise e
 
+    def __getAccessToken(self):
+        '''
+        Gets the OAuth access token of the region, fetching a new one if it
+        does not exist or expires in the next 30 seconds.
+
+        @return access token
+
+        @throws WowApiOauthException Thrown if the token cannot be fetched
+        '''
+        token = self.api._access_tokens.get(self.region)
+        if token is None or datetime.utcnow() >= token['expiration'] - timedelta(seconds=30):
+            self.api._get_client_credentials(self.region)
+        return self.api._access_tokens[self.region]['token']
+
+    def __streamListings(self, resource, ijson):
+        '''
+        Streams the auction listings of the given resource. The response is
+        parsed incrementally, so memory use does not grow with the size of the
+        auction house.
+
+        @param resource Path of the auctions resource
+        @param ijson ijson module used to parse the response
+
+        @return generator of auction listings
+
+        @throws WowApiException     Thrown if query returns 400
+        @throws Exception           Thrown when any other exception is caught
+        '''
+        try:
+            url = 'https://{0}.api.blizzard.com/{1}'.format(self.region, resource)
+            res = self.api._session.get(url, params={'namespace': 'dynamic-' + self.region, 'locale': self.locale},
+                headers={'Authorization': 'Bearer ' + self.__getAccessToken()}, stream=True)
+            if not res.ok:
+                raise WowApiException('Invalid response - {0} - {1}'.format(url, res.status_code))
+            res.raw.decode_content = True
+            with res:
+                for listing in ijson.items(res.raw, 'auctions.item', use_float=True):
+                    yield listing
+        except (Exception, WowApiException) as e:
+            logging.exception(str(e))
+            raise e
+
+    def streamAuctions(self, connected_realm_id=None):
+        '''
+        Streams the auction listings of the given connected realm. If no
+        argument is passed, connected_realm_id is used. Falls back to
+        findAuctions if ijson is not installed.
+
+        @param  connected_realm_id  Initialized to None if no argument passed
+
+        @return generator of auction listings
+        '''
+        if connected_realm_id == None:
+            connected_realm_id = self.connected_realm_id
+        try:
+            import ijson
+        except ImportError:
+            logging.warning('ijson is not installed, downloading auctions in one piece')
+            return iter(self.findAuctions(connected_realm_id))
+        return self.__streamListings('data/wow/connected-realm/{0}/auctions'.format(connected_realm_id), ijson)
+
+    def streamCommodities(self):
+        '''
+        Streams the region-wide commodity auction listings. The response is
+        parsed incrementally with ijson, so memory use does not grow with the
+        size of the auction house.
+
+        @return generator of commodity listings
+
+        @throws ImportError         Thrown if ijson is not installed
+        '''
+        try:
+            import ijson
+        except ImportError as e:
+            logging.exception('ijson is required to stream commodities')
+            raise e
+        return self.__streamListings('data/wow/auctions/commodities', ijson)
+
     @property
     def locale(self):
         '''